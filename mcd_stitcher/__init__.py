@@ -1,42 +1,49 @@
 import click
 from pathlib import Path
-from .converter import Imc2Zarr, imc2zarr, main as converter_main
+from .converter import Imc2Zarr, imc2zarr, main as converter_main, ZARR_COMPRESSION_LEVEL
 from .stitcher import ZarrStitcher, main as stitcher_main
 
-__version__ = "0.1.2"
+__version__ = "1.0.0"
 
-def mcd_stitch(mcd_folder, zarr_folder=None, use_lzw=False):
-    mcd_path = Path(mcd_folder)
-    
-    # Determine the appropriate zarr_folder
-    if not zarr_folder:
-        if mcd_path.is_file():
-            zarr_folder = mcd_path.parent / "Zarr_converted"
-        else:
-            zarr_folder = mcd_path / "Zarr_converted"
-
-    # Run imc2zarr conversion
-    imc2zarr(mcd_folder, zarr_folder)
+def mcd_stitch(mcd_folder, zarr_folder=None, use_lzw=False, use_zip=False, use_shards=False, jobs=None,
+               compression_level=ZARR_COMPRESSION_LEVEL, dtype=None, use_zlib=False):
+    # Run imc2zarr conversion, the converter resolves the default zarr_folder
+    converter = Imc2Zarr(
+        mcd_folder, zarr_folder, use_zip=use_zip, use_shards=use_shards, jobs=jobs,
+        compression_level=compression_level, dtype=dtype
+    )
+    converter.convert()
 
     # Run zarr stitching
-    stitcher = ZarrStitcher(zarr_folder, use_lzw=use_lzw)
+    stitcher = ZarrStitcher(
+        converter.output_path, use_lzw=use_lzw, jobs=jobs, compression='zlib' if use_zlib else None
+    )
     stitcher.process_all_folders()
 
 @click.command(context_settings=dict(help_option_names=['-h', '--help']))
-@click.argument("mcd_folder", type=click.Path(exists=True))
-@click.argument("zarr_folder", type=click.Path(), required=False)
+@click.argument("mcd_folder", type=click.Path(exists=True, path_type=Path))
+@click.argument("zarr_folder", type=click.Path(path_type=Path), required=False)
 @click.option("--lzw", is_flag=True, help="Enable LZW compression")
-def main(mcd_folder, zarr_folder, lzw):
+@click.option("--zlib", "use_zlib", is_flag=True, help="Enable zlib compression with horizontal predictor")
+@click.option("--zip", "use_zip", is_flag=True, help="Write each Zarr store as a single zip file")
+@click.option("--shard", "use_shards", is_flag=True, help="Store each acquisition as a single shard file")
+@click.option("-j", "--jobs", type=click.IntRange(min=1), default=None, help="Number of mcd files converted and stitched in parallel, defaults to all cores")
+@click.option("--compression-level", type=click.IntRange(0, 9), default=ZARR_COMPRESSION_LEVEL, show_default=True, help="zstd compression level of the Zarr chunks")
+@click.option("--dtype", type=click.Choice(["float32", "uint16"]), default=None, help="Store acquisitions with this data type, defaults to float32 as in the mcd file")
+@click.option("-v", "--verbose", is_flag=True, help="Print the full traceback on errors")
+def main(mcd_folder, zarr_folder, lzw, use_zlib, use_zip, use_shards, jobs, compression_level, dtype, verbose):
     """
     For more information on command usage, visit:
     https://github.com/PawanChaurasia/mcd_stitcher
     """
     try:
-        mcd_stitch(mcd_folder, zarr_folder, use_lzw=lzw)
+        mcd_stitch(mcd_folder, zarr_folder, use_lzw=lzw, use_zip=use_zip, use_shards=use_shards, jobs=jobs,
+                   compression_level=compression_level, dtype=dtype, use_zlib=use_zlib)
     except Exception as err:
         print(f"Error: {str(err)}")
-        import traceback
-        print(f"Details: {traceback.format_exc()}")
+        if verbose:
+            import traceback
+            print(f"Details: {traceback.format_exc()}")
 
 if __name__ == "__main__":
     main(prog_name="mcd_stitch")
@@ -1,12 +1,44 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import os
 import json
-import xarray as xr
+import numpy as np
+import zarr
 import click
 import traceback
+from numcodecs import blosc
+from zarr.codecs import BloscCodec
 from .imclib.imcraw import ImcRaw
 
+# Blosc threads serve calls from the main thread, calls from the acquisition pool
+# already compress in parallel without the GIL, so keep the count small
+blosc.set_nthreads(min(4, os.cpu_count() or 1))
+
+# IMC channels are smooth integer-valued images, bitshuffle + zstd compresses them well and fast
+# level 1 is the speed/size knee: much faster than the default 3 for slightly larger stores
+ZARR_COMPRESSION_LEVEL = 1
+
+
+def _json_safe(obj):
+    """Coerce metadata into JSON types in one pass, stringifying anything unknown."""
+    if isinstance(obj, dict):
+        return {
+            str.__str__(k) if isinstance(k, str) else json.dumps(k): _json_safe(v)
+            for k, v in obj.items()
+        }
+    if isinstance(obj, (list, tuple)):
+        return [_json_safe(v) for v in obj]
+    if isinstance(obj, str):
+        # plain str for str-based enums
+        return str.__str__(obj)
+    if obj is None or isinstance(obj, (bool, int, float)):
+        return obj
+    return str(obj)
+
+
 class Imc2Zarr:
-    def __init__(self, input_path, output_path=None):
+    def __init__(self, input_path, output_path=None, tile_size=None, use_zip=False, use_shards=False,
+                 jobs=None, compression_level=ZARR_COMPRESSION_LEVEL, dtype=None):
         self.input_path = Path(input_path)
         if self.input_path.is_file():
             # If input is a file, set output path to the parent directory
@@ -15,22 +47,59 @@ class Imc2Zarr:
             # If input is a directory, use the directory directly
             self.output_path = Path(output_path) if output_path else self.input_path / "Zarr_converted"
         self.output_fn = None
+        # None stores one channel per chunk, otherwise chunks hold all channels of a tile_size tile
+        self.tile_size = tile_size
+        # write each Zarr hierarchy into a single <name>.zip instead of one file per chunk
+        self.use_zip = use_zip
+        # store each acquisition as a single shard file holding all of its chunks
+        self.use_shards = use_shards
+        # number of mcd files converted in parallel processes, None uses all cores
+        self.jobs = jobs
+        # writer threads per mcd file, shared out between the processes when several files run at once
+        self.threads = os.cpu_count() or 1
+        self.compressor = BloscCodec(cname='zstd', clevel=compression_level, shuffle='bitshuffle')
+        # None keeps the acquisition dtype (float32), uint16 halves the store for integer ion counts
+        self.dtype = np.dtype(dtype) if dtype else None
 
     def convert(self):
-        txt_fns = list(self.input_path.glob('*.txt'))
-
         # check whether the input_path points to an mcd file or a folder
         if self.input_path.is_file():
-            if self.input_path.suffix != '.mcd':
+            if self.input_path.suffix.lower() != '.mcd':
                 raise Exception('Input file does not seem to be a valid mcd file')
-            self._process_file(self.input_path, txt_fns)
+            self._process_file(self.input_path, [])
         else:
+            mcd_files, txt_fns = self._scan_input_folder()
             # check if mcd file exists
-            mcd_files = list(self.input_path.glob('*.mcd'))
             if not mcd_files:
                 raise Exception('No mcd file was found in the input folder')
-            for mcd_fn in mcd_files:
-                self._process_file(mcd_fn, txt_fns)
+            jobs = min(self.jobs or os.cpu_count() or 1, len(mcd_files))
+            if jobs == 1:
+                for mcd_fn in mcd_files:
+                    self._process_file(mcd_fn, txt_fns)
+            else:
+                # mcd files are independent, convert them in separate processes,
+                # each with a share of the cores so the total thread count stays at the core count
+                self.threads = max(1, (os.cpu_count() or 1) // jobs)
+                with ProcessPoolExecutor(max_workers=jobs) as executor:
+                    futures = [executor.submit(self._process_file, mcd_fn, txt_fns) for mcd_fn in mcd_files]
+                    for future in futures:
+                        self.output_fn = future.result()
+
+    def _scan_input_folder(self):
+        # classify mcd and txt files in a single directory pass
+        mcd_files, txt_fns = [], []
+        with os.scandir(self.input_path) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                name = entry.name.lower()
+                if name.endswith('.mcd'):
+                    mcd_files.append((entry.stat().st_size, Path(entry.path)))
+                elif name.endswith('.txt'):
+                    txt_fns.append(Path(entry.path))
+        # largest files first, so the longest conversions do not start last in the pool
+        mcd_files.sort(key=lambda item: item[0], reverse=True)
+        return [mcd_fn for _, mcd_fn in mcd_files], txt_fns
 
     def _process_file(self, mcd_fn, txt_fns):
         imc_scans = []
@@ -51,80 +120,148 @@ class Imc2Zarr:
         # run the conversion
         data_imc_scan = data_imc_scans[0]
         self.output_fn = self.output_path.joinpath(input_name)
-        # save acquisitions into Zarr
-        self._convert2zarr(data_imc_scan)
-        # save raw metadata and snapshots
-        self._save_auxiliary_data(
-            data_imc_scan,
-            xml_path=self.output_fn,
-            snapshots_path=self.output_fn.joinpath('snapshots')
-        )
-        # save raw metadata and snapshots from auxiliary mcd files
-        for aux_scan in auxiliary_imc_scans:
-            auxiliary_output_path = 'auxiliary/{}'.format(
-                aux_scan.mcd_fn.name[: -len(aux_scan.mcd_fn.suffix)]
-            )
-            auxiliary_output_path = self.output_fn.joinpath(auxiliary_output_path)
-            self._save_auxiliary_data(
-                aux_scan,
-                xml_path=auxiliary_output_path,
-                snapshots_path=auxiliary_output_path
-            )
+        store = self._open_store()
+        try:
+            # acquisitions, raw metadata and snapshots are independent writes, run them in one pool
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                # save acquisitions into Zarr
+                futures = self._convert2zarr(data_imc_scan, store, executor)
+                # save raw metadata and snapshots
+                futures += self._save_auxiliary_data(
+                    data_imc_scan,
+                    executor,
+                    xml_path=self.output_fn,
+                    snapshots_path=self.output_fn.joinpath('snapshots')
+                )
+                # save raw metadata and snapshots from auxiliary mcd files
+                for aux_scan in auxiliary_imc_scans:
+                    auxiliary_output_path = 'auxiliary/{}'.format(
+                        aux_scan.mcd_fn.name[: -len(aux_scan.mcd_fn.suffix)]
+                    )
+                    auxiliary_output_path = self.output_fn.joinpath(auxiliary_output_path)
+                    futures += self._save_auxiliary_data(
+                        aux_scan,
+                        executor,
+                        xml_path=auxiliary_output_path,
+                        snapshots_path=auxiliary_output_path
+                    )
+                for future in as_completed(futures):
+                    # re-raise the first error from any task
+                    future.result()
+        finally:
+            # the pool has finished all writes once the with block exits
+            store.close()
 
         for imc_scan in imc_scans:
             imc_scan.close()
 
         # Print conversion success message
         print(f"{mcd_fn.name} converted successfully")
+        return self.output_fn
+
+    def _open_store(self):
+        if self.use_zip:
+            self.output_path.mkdir(parents=True, exist_ok=True)
+            return zarr.storage.ZipStore(str(self.output_fn) + '.zip', mode='w')
+        return zarr.storage.LocalStore(str(self.output_fn))
+
+    def _convert2zarr(self, imc: ImcRaw, store, executor):
+        # open the store once and write the hierarchy directly, without xarray
+        # attributes are set on creation, zip entries cannot be rewritten
+        root = zarr.open_group(store=store, mode='w', attributes={
+            'meta': [_json_safe(imc.meta_summary)],
+            'raw_meta': imc.rawmeta,
+        })
+        # acquisitions write to disjoint groups, so they can be converted concurrently
+        return [executor.submit(self._write_acquisition, root, imc, q) for q in imc.acquisitions]
+
+    def _write_acquisition(self, root, imc: ImcRaw, q):
+        shape, dtype, channels = imc.get_acquisition_channels(q)
+        if self.dtype is not None:
+            dtype = self.dtype
+        q_name = 'Q{}'.format(str(q.id).zfill(3))
+        meta = [_json_safe(q.meta_summary)]
+        grp = root.create_group(q_name, attributes={'meta': meta})
+        chunks = self._chunk_shape(shape)
+        shards = self._shard_shape(shape, chunks) if self.use_shards else None
+        # array keeps the group name so readers can access it as <group>/<group>
+        arr = grp.create_array(
+            q_name,
+            shape=shape,
+            chunks=chunks,
+            shards=shards,
+            dtype=dtype,
+            compressors=self.compressor,
+            attributes={'meta': meta},
+            dimension_names=('channel', 'y', 'x')
+        )
+        if self.tile_size or shards:
+            # chunks or shards span all channels, write them in a single pass
+            arr[...] = self._cast(np.stack(list(channels)), dtype)
+        else:
+            # stream one channel at a time so only a single plane is held in memory
+            for idx, plane in enumerate(channels):
+                arr[idx] = self._cast(plane, dtype)
+
+    @staticmethod
+    def _cast(data, dtype):
+        if data.dtype == dtype:
+            return data
+        if np.issubdtype(dtype, np.integer):
+            # clip into the integer range and cast in one pass, values are truncated like in the stitcher
+            info = np.iinfo(dtype)
+            return np.clip(data, info.min, info.max, out=np.empty(data.shape, dtype=dtype), casting='unsafe')
+        return data.astype(dtype)
+
+    def _chunk_shape(self, shape):
+        nchannels, ny, nx = shape
+        if self.tile_size:
+            # tile-major: every chunk holds all channels of a spatial tile
+            return (nchannels, min(self.tile_size, ny), min(self.tile_size, nx))
+        # channel-major: reading one channel decompresses only that channel
+        return (1, ny, nx)
+
+    @staticmethod
+    def _shard_shape(shape, chunks):
+        # one shard covers the whole acquisition, rounded up to a multiple of the chunk shape
+        return tuple(-(-size // chunk) * chunk for size, chunk in zip(shape, chunks))
 
-    def _convert2zarr(self, imc: ImcRaw):
-        ds = xr.Dataset()
-        # set meta for root
-        ds.attrs['meta'] = [json.loads(json.dumps(imc.meta_summary, default=str))]
-        ds.attrs['raw_meta'] = imc.rawmeta
-        ds.to_zarr(self.output_fn, mode='w')
-        # loop over all acquisitions to read and store channel data
-        for q in imc.acquisitions:
-            data = imc.get_acquisition_data(q)
-            nchannels, ny, nx = data.shape
-            q_name = 'Q{}'.format(str(q.id).zfill(3))
-            ds_q = xr.Dataset()
-            arr = xr.DataArray(
-                data,
-                dims=('channel', 'y', 'x'),
-                name='data',
-                coords={
-                    'channel': range(nchannels),
-                    'y': range(ny),
-                    'x': range(nx)
-                },
-            )
-            arr.attrs['meta'] = [json.loads(json.dumps(q.meta_summary, default=str))]
-            ds_q[q_name] = arr
-            ds_q.attrs['meta'] = arr.attrs['meta']
-            # append acquisition to existing dataset
-            ds_q.to_zarr(self.output_fn, group=q_name, mode='a')
-
-    def _save_auxiliary_data(self, imc: ImcRaw, xml_path, snapshots_path):
+    def _save_auxiliary_data(self, imc: ImcRaw, executor, xml_path, snapshots_path):
         # save raw meta as xml file
-        imc.save_meta_xml(xml_path)
+        futures = [executor.submit(imc.save_meta_xml, xml_path)]
         # save snapshots
-        imc.save_snapshot_images(snapshots_path)
+        snapshots_path.mkdir(parents=True, exist_ok=True)
+        for obj in imc.snapshot_objects():
+            futures.append(executor.submit(imc.save_snapshot_image, obj, snapshots_path))
+        return futures
 
-def imc2zarr(input_path, output_path=None):
-    imc2zarr_converter = Imc2Zarr(input_path, output_path)
+def imc2zarr(input_path, output_path=None, tile_size=None, use_zip=False, use_shards=False, jobs=None,
+             compression_level=ZARR_COMPRESSION_LEVEL, dtype=None):
+    imc2zarr_converter = Imc2Zarr(
+        input_path, output_path, tile_size=tile_size, use_zip=use_zip, use_shards=use_shards, jobs=jobs,
+        compression_level=compression_level, dtype=dtype
+    )
     imc2zarr_converter.convert()
     return imc2zarr_converter.output_fn
 
 @click.command()
 @click.argument("input_path")
 @click.argument("output_path", required=False)
-def main(input_path, output_path):
+@click.option("--tile-size", type=click.IntRange(min=1), default=None, help="Chunk acquisitions into tiles of this size instead of one chunk per channel")
+@click.option("--zip", "use_zip", is_flag=True, help="Write each Zarr store as a single zip file")
+@click.option("--shard", "use_shards", is_flag=True, help="Store each acquisition as a single shard file")
+@click.option("-j", "--jobs", type=click.IntRange(min=1), default=None, help="Number of mcd files converted in parallel, defaults to all cores")
+@click.option("--compression-level", type=click.IntRange(0, 9), default=ZARR_COMPRESSION_LEVEL, show_default=True, help="zstd compression level of the Zarr chunks")
+@click.option("--dtype", type=click.Choice(["float32", "uint16"]), default=None, help="Store acquisitions with this data type, defaults to float32 as in the mcd file")
+@click.option("-v", "--verbose", is_flag=True, help="Print the full traceback on errors")
+def main(input_path, output_path, tile_size, use_zip, use_shards, jobs, compression_level, dtype, verbose):
     try:
-        imc2zarr(input_path, output_path)
+        imc2zarr(input_path, output_path, tile_size=tile_size, use_zip=use_zip, use_shards=use_shards, jobs=jobs,
+                 compression_level=compression_level, dtype=dtype)
     except Exception as err:
         print("Error: {}".format(str(err)))
-        print("Details: {}".format(traceback.format_exc()))
+        if verbose:
+            print("Details: {}".format(traceback.format_exc()))
 
 if __name__ == "__main__":
     main()
@@ -1,5 +1,6 @@
 import os
 import re
+import threading
 import xml.etree.ElementTree as et
 from pathlib import Path
 
@@ -22,16 +23,25 @@ class ImcDataParser:
         """
         self._mcd_fsize = os.path.getsize(mcdfilename)
         self._mcd_fh = open(Path(mcdfilename), mode="rb")
+        # acquisitions are read front to back, ask the kernel for a larger readahead
+        try:
+            os.posix_fadvise(self._mcd_fh.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            # not available on Windows and macOS
+            pass
         if metafilename is None:
             self._meta_fh = self._mcd_fh
         else:
             self._meta_fh = open(Path(metafilename), mode="rb")
-        self._txt_fhs = []
-        for tf in textfilenames:
-            self._txt_fhs.append(open(Path(tf), mode="r"))
+        # text files are only a fallback, they are opened when an acquisition needs them
+        self._txt_fns = [Path(tf) for tf in textfilenames or []]
+        self._txt_fhs = {}
         self._xml = None
         self._ns = None
         self._use_mmap = True  # awlays use memorymaps
+        # file handles are shared, serialise reads when called from several threads
+        self._read_lock = threading.Lock()
+        self._mcd_mm = None
         self.meta = None
 
     def read_mcd_xml(self):
@@ -55,64 +65,100 @@ class ImcDataParser:
         self.meta = McdXmlParser(self._xml, self._meta_fh.name)
 
     def get_acquisition_data(self, q: Acquisition):
-        # initialise data as 3D array with empty values
-        img = None
-        mcd_valid = txt_valid = False
+        with self._read_lock:
+            return self._get_acquisition_data(q)
+
+    def get_acquisition_channels(self, q: Acquisition):
+        """
+        Read acquisition data one channel at a time
+
+        :param q: the acquisition
+        :returns: (nchannels, ny, nx) shape, dtype and an iterator over the channel planes
+        """
+        with self._read_lock:
+            try:
+                buffer, shape = self._read_mcd_acquisition_buffer(q)
+            except Exception:
+                buffer = None
+            if buffer is None:
+                # text and invalid acquisitions can only be read as a whole
+                img = self._read_fallback_acquisition_data(q)
+                return img.shape, img.dtype, iter(img)
+            q.meta_summary['q_data_source'] = 'mcd'
+        npixels = shape[0] * shape[1]
+        # column views into the memory map, each plane is only read when consumed
+        planes = (
+            buffer[:npixels, idx].reshape(shape[1], shape[0])
+            for idx in range(q.n_channels)
+        )
+        return (q.n_channels, shape[1], shape[0]), buffer.dtype, planes
+
+    def _get_acquisition_data(self, q: Acquisition):
         # try to read data from mcd
         try:
             img = self._read_mcd_acquisition_data(q)
-            mcd_valid = True
         except Exception:
-            pass
-        # if mcd is invalid try to read data from text
-        if not mcd_valid:
-            try:
-                img = self._read_txt_acquisition_data(q)
-                txt_valid = True
-            except Exception:
-                pass
-        # ToDo: if both sources are invalid try to read from mcd using different data size
+            return self._read_fallback_acquisition_data(q)
+        q.meta_summary['q_data_source'] = 'mcd'
+        return img
 
-        if mcd_valid:
-            source = 'mcd'
-        elif txt_valid:
+    def _read_fallback_acquisition_data(self, q: Acquisition):
+        # if mcd is invalid try to read data from text
+        try:
+            img = self._read_txt_acquisition_data(q)
             source = 'txt'
-        else:
-            source = 'invalid'
+        except Exception:
+            # ToDo: if both sources are invalid try to read from mcd using different data size
             img = np.zeros((1, 1, 1))
+            source = 'invalid'
         q.meta_summary['q_data_source'] = source
         return img
 
-    def _read_mcd_acquisition_data(self, q: Acquisition):
+    def _get_mcd_memmap(self):
+        # map the whole mcd once, acquisitions are sliced from it as views
+        if self._mcd_mm is None:
+            self._mcd_mm = np.memmap(self._mcd_fh, dtype=np.uint8, mode="r")
+        return self._mcd_mm
+
+    def _read_mcd_acquisition_buffer(self, q: Acquisition):
         data_size = q.data_size
         data_nrows = q.data_nrows
         if q.data_offset_start >= q.data_offset_end \
                 or (q.data_offset_start + data_size) > self._mcd_fsize:
             raise Exception('Invalid acquisition buffer size')
-        buffer = np.memmap(
-            self._mcd_fh,
-            dtype="<f",  # little-endian
-            mode="r",
-            offset=q.data_offset_start,
-            shape=(int(data_size / q.value_bytes)),
-        )
-        data = np.array([buffer[idx::q.n_channels] for idx in range(q.n_channels)])
-        shape = [int(data[0].max()) + 1, int(data[1].max()) + 1]
+        start = q.data_offset_start
+        end = start + data_nrows * q.n_channels * q.value_bytes
+        # channels are read strided from the map, let the kernel page in the whole block up front
+        try:
+            os.posix_fadvise(self._mcd_fh.fileno(), start, end - start, os.POSIX_FADV_WILLNEED)
+        except (AttributeError, OSError):
+            pass
+        # one row per pixel, one column per channel
+        buffer = self._get_mcd_memmap()[start:end].view("<f")  # little-endian
+        buffer = buffer.reshape(data_nrows, q.n_channels)
+        # the first two channels hold the pixel x and y coordinates
+        shape = McdUtils.get_shape_from_acq_data(buffer).tolist()
         if np.prod(shape) > data_nrows:
             shape[1] -= 1
+        if np.prod(shape) > data_nrows:
+            raise Exception('Acquisition buffer is smaller than its pixel grid')
         q.meta_summary['q_width'] = shape[0]
         q.meta_summary['q_height'] = shape[1]
-        data = data[:, :(np.prod(shape))]
-        data = np.reshape(data, [q.n_channels, shape[1], shape[0]], order='C')
-        return data
+        return buffer, shape
+
+    def _read_mcd_acquisition_data(self, q: Acquisition):
+        buffer, shape = self._read_mcd_acquisition_buffer(q)
+        data = buffer[:shape[0] * shape[1]].reshape(shape[1], shape[0], q.n_channels)
+        # a single copy from pixel-major to channel-major order
+        return np.ascontiguousarray(np.moveaxis(data, -1, 0))
 
     def _read_txt_acquisition_data(self, q: Acquisition):
         # look for available text files matching the acquisition ID
         fn_end = '{}_{}.txt'.format(q.get_property(defs.DESCRIPTION), q.id)
         q.txt_fh = None
-        for fh in self._txt_fhs:
-            if fh.name.endswith(fn_end):
-                q.txt_fh = fh
+        for tf in self._txt_fns:
+            if str(tf).endswith(fn_end):
+                q.txt_fh = self._open_txt_file(tf)
                 break
         if not q.txt_fh:
             raise Exception('Acquisition has no text file')
@@ -123,6 +169,11 @@ class ImcDataParser:
         q.meta_summary['q_height'] = shape[1]
         return data
 
+    def _open_txt_file(self, tf):
+        if tf not in self._txt_fhs:
+            self._txt_fhs[tf] = open(tf, mode="r")
+        return self._txt_fhs[tf]
+
     def save_snapshot_image(self, obj, out_folder):
         fn = []
         start_offset = []
@@ -148,18 +199,21 @@ class ImcDataParser:
                 if data_length <= 0:
                     continue
                 fp = out_folder.joinpath(fn[i])
-                if self._use_mmap:
-                    buffer = McdUtils.read_mcd_buffer_mmap(self._mcd_fh, start_offset[i], data_length)
+                # slice the shared map of the mcd instead of mapping the file per image
+                with self._read_lock:
+                    mm = self._get_mcd_memmap()
+                buffer = mm[start_offset[i]:start_offset[i] + data_length]
                 with open(fp, "wb") as f:
-                    f.write(buffer)
+                    f.write(memoryview(buffer))
 
     def close(self):
         """Close file handles"""
+        self._mcd_mm = None
         try:
             self._mcd_fh.close()
             if self._mcd_fh != self._meta_fh:
                 self._meta_fh.close()
-            for tfh in self._txt_fhs:
+            for tfh in self._txt_fhs.values():
                 tfh.close()
         except Exception:
             pass
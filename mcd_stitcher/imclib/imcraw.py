@@ -139,17 +139,23 @@ class ImcRaw:
     def get_acquisition_data(self, q: Acquisition):
         return self._parser.get_acquisition_data(q)
 
+    def get_acquisition_channels(self, q: Acquisition):
+        return self._parser.get_acquisition_channels(q)
+
     def close(self):
         self._parser.close()
 
+    def snapshot_objects(self):
+        # slides, panoramas and acquisitions all carry snapshot images
+        return [*self.slides, *self.panoramas, *self.acquisitions]
+
+    def save_snapshot_image(self, obj, out_folder):
+        self._parser.save_snapshot_image(obj, out_folder)
+
     def save_snapshot_images(self, out_folder):
         out_folder.mkdir(parents=True, exist_ok=True)
-        for s in self.slides:
-            self._parser.save_snapshot_image(s, out_folder)
-        for p in self.panoramas:
-            self._parser.save_snapshot_image(p, out_folder)
-        for q in self.acquisitions:
-            self._parser.save_snapshot_image(q, out_folder)
+        for obj in self.snapshot_objects():
+            self._parser.save_snapshot_image(obj, out_folder)
 
     def save_meta_xml(self, out_folder):
         out_folder.mkdir(parents=True, exist_ok=True)
@@ -1,25 +1,28 @@
-import array
 import mmap
 import os
-from collections import defaultdict
 
 import numpy as np
 import pandas as pd
 
 from .metadefs import MetaDefinitions as defs
 
+# leaf tags whose text is converted to int
+_INT_TAGS = frozenset({defs.ID, defs.ORDERNUMBER})
+
 
 class McdUtils:
     """Static method helpers for parsing MCD file format"""
     _start_str = "<MCDSchema"
     _stop_str = "</MCDSchema>"
-    _meta_length = 100 * 1024 ** 2
+    # initial tail window searched for the xml, grown until the start tag is found
+    _meta_length = 1024 ** 2
 
     @staticmethod
     def read_mcd_xml_mmap(fh):
         """
         Finds the MCD metadata XML in the binary and updates the mcdparser object.
-        As suggested in the specifications the file is parsed from the end.
+        As suggested in the specifications the file is parsed from the end,
+        starting with a small tail window that grows until the xml is found.
 
         :param fn:
         :param start_str:
@@ -27,38 +30,14 @@ class McdUtils:
         """
         size = os.fstat(fh.fileno()).st_size
         length = McdUtils._meta_length if McdUtils._meta_length < size else size
-        offset = size - length
-        map_start = offset - offset % mmap.ALLOCATIONGRANULARITY
-        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ, offset=map_start)
-
-        start_str = McdUtils._start_str
-        stop_str = McdUtils._stop_str
-
-        xml_start = mm.rfind(start_str.encode("utf-8"))
-
-        if xml_start == -1:
-            start_str = McdUtils._add_nullbytes(start_str)
-            xml_start = mm.rfind(start_str.encode("utf-8"))
-
-        if xml_start == -1:
+        xml = McdUtils._read_mcd_xml_tail(fh, length)
+        while xml is None and length < size:
+            length = min(length * 4, size)
+            xml = McdUtils._read_mcd_xml_tail(fh, length)
+        if xml is None:
             raise ValueError(
                 "Invalid MCD: MCD xml start tag not found in file %s" % fh.name
             )
-        else:
-            xml_stop = mm.rfind(stop_str.encode("utf-8"))
-            if xml_stop == -1:
-                stop_str = McdUtils._add_nullbytes(stop_str)
-                xml_stop = mm.rfind(stop_str.encode("utf-8"))
-                # xmls = [mm[start:end] for start, end in zip(xml_starts, xml_stops)]
-
-        if xml_stop == -1:
-            raise ValueError(
-                "Invalid MCD: MCD xml stop tag not found in file %s" % fh.name
-            )
-        else:
-            xml_stop += len(stop_str)
-
-        xml = mm[xml_start:xml_stop].decode("utf-8")
         return xml
 
     @staticmethod
@@ -66,66 +45,85 @@ class McdUtils:
         """
         Finds the MCD metadata XML in the binary.
         As suggested in the specifications the file is parsed from the end.
+        Unlike read_mcd_xml_mmap the whole file is searched at once.
 
         :param fn:
         :param start_str:
         :param stop_str:
         """
-        start_str = McdUtils._start_str
-        stop_str = McdUtils._stop_str
-
-        xml_start = McdUtils._reverse_find_in_buffer(fh, start_str.encode("utf-8"))
-
-        if xml_start == -1:
-            start_str = McdUtils._add_nullbytes(start_str)
-            xml_start = McdUtils._reverse_find_in_buffer(fh, start_str.encode("utf-8"))
-
-        if xml_start == -1:
+        size = os.fstat(fh.fileno()).st_size
+        xml = McdUtils._read_mcd_xml_tail(fh, size)
+        if xml is None:
             raise ValueError(
                 "Invalid MCD: MCD xml start tag not found in file %s" % fh.name
             )
-        else:
-            xml_stop = McdUtils._reverse_find_in_buffer(fh, stop_str.encode("utf-8"))
+        return xml
+
+    @staticmethod
+    def _read_mcd_xml_tail(fh, length):
+        """
+        Searches the last length bytes of the file for the MCD metadata XML
+        with mmap.rfind.
+
+        :param fh: binary file handle of the mcd file
+        :param length: number of bytes at the end of the file to search
+        :return: the xml string, None if the start tag is not within length
+        """
+        size = os.fstat(fh.fileno()).st_size
+        offset = size - length
+        map_start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ, offset=map_start) as mm:
+            start_str = McdUtils._start_str
+            stop_str = McdUtils._stop_str
+
+            xml_start = mm.rfind(start_str.encode("utf-8"))
+
+            if xml_start == -1:
+                xml_start = mm.rfind(McdUtils._add_nullbytes(start_str))
+
+            if xml_start == -1:
+                return None
+
+            xml_stop = mm.rfind(stop_str.encode("utf-8"))
             if xml_stop == -1:
                 stop_str = McdUtils._add_nullbytes(stop_str)
-                xml_stop = McdUtils._reverse_find_in_buffer(fh, stop_str.encode("utf-8"))
-                # xmls = [mm[start:end] for start, end in zip(xml_starts, xml_stops)]
+                xml_stop = mm.rfind(stop_str)
 
-        if xml_stop == -1:
-            raise ValueError(
-                "Invalid MCD: MCD xml stop tag not found in file %s" % fh.name
-            )
-        else:
-            xml_stop += len(stop_str)
+            if xml_stop == -1:
+                raise ValueError(
+                    "Invalid MCD: MCD xml stop tag not found in file %s" % fh.name
+                )
+            else:
+                xml_stop += len(stop_str)
 
-        fh.seek(xml_start)
-        xml = fh.read(xml_stop - xml_start).decode("utf-8")
+            xml = mm[xml_start:xml_stop].decode("utf-8")
         return xml
 
-    @staticmethod
-    def read_mcd_buffer_mmap(fh, start_offset, length):
-        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
-        mm.seek(start_offset)
-        return mm.read(length)
-
     @staticmethod
     def get_shape_from_acq_data(data):
-        shape = data[:, :2].max(axis=0) + 1
+        # reduce the x and y columns separately, data[:, :2] is strided for many channels
+        x_max = int(data[:, 0].max())
+        y_max = int(data[:, 1].max())
         # if np.prod(shape) > data.shape[0]:
         #     shape[1] -= 1
-        shape = shape.astype(int)
-        return shape
+        return np.array([x_max + 1, y_max + 1], dtype=np.int64)
 
     @staticmethod
     def valid_txt_file(fh, valid_lines=2):
         fh.seek(0)
         valid = False
-        num_lines = 0
-        for line in fh:
-            num_lines += 1
-            if num_lines >= valid_lines:
+        head = ""
+        # read blocks until the head holds valid_lines lines, usually a single read
+        while True:
+            block = fh.read(65536)
+            head += block
+            lines = head.split("\n", valid_lines - 1)
+            if len(lines) == valid_lines and lines[-1]:
                 valid = True
                 break
+            if not block:
+                break
+        fh.seek(0)
         return valid
 
     @staticmethod
@@ -134,136 +132,86 @@ class McdUtils:
         header = fh.readline().split("\t")
         channel_names = header[first_col:]
         nchan = len(channel_names)
-        rawar = array.array("f")
-        for raw in fh:
-            for v in raw.split("\t")[first_col:]:
-                rawar.append(float(v))
-        nrow = int(len(rawar) / nchan)
-        data = np.array([rawar[idx::nchan] for idx in range(nchan)])
-        shape = [int(data[0].max()) + 1, int(data[1].max()) + 1]
+        # parse all values with the C tokenizer, one row per pixel
+        rawar = pd.read_csv(
+            fh,
+            sep="\t",
+            header=None,
+            engine="c",
+            dtype=np.float32,
+            usecols=list(range(first_col, first_col + nchan)),
+        ).to_numpy()
+        nrow = rawar.shape[0]
+        # the first two columns hold the pixel x and y coordinates
+        shape = McdUtils.get_shape_from_acq_data(rawar).tolist()
         if np.prod(shape) > nrow:
             shape[1] -= 1
-        data = data[:, :(np.prod(shape))]
+        data = rawar.T[:, :(np.prod(shape))]
         data = np.reshape(data, [nchan, shape[1], shape[0]], order='C')
         return data, shape, channel_names
 
     @staticmethod
     def read_acquisition_text_data_2(fh, first_col=3):
-        fh.seek(0)
-        header = fh.readline().split("\t")
-        channel_names = header[first_col:]
-        nchan = len(channel_names)
-        data = []
-        for c_idx in range(first_col, nchan + first_col):
-            ch_data = McdUtils._read_channel_text_data_pd(fh, c_idx)
-            data.append(ch_data)
-        shape = [int(data[0].max()) + 1, int(data[1].max()) + 1]
-        if np.prod(shape) > data[0].shape[0]:
-            shape[1] -= 1
-        data = np.hstack(data)
-        data = data[:, :(np.prod(shape))]
-        data = np.reshape(data, [nchan, shape[1], shape[0]], order='C')
-        return data, shape, channel_names
+        # both readers parse all channel columns in a single pass, keep one implementation
+        return McdUtils.read_acquisition_text_data(fh, first_col=first_col)
 
     @staticmethod
-    def _read_channel_text_data_pd(fh, ch_col):
-        fh.seek(0)
-        ch_data = pd.read_table(
-            fh,
-            dtype='f',
-            engine="c",
-            skiprows=0,
-            usecols=[ch_col],
-        )
-        return ch_data
-
-    @staticmethod
-    def _read_channel_text_data_np(fh, ch_col):
-        fh.seek(0)
-        ch_data = np.genfromtxt(
-            fh,
-            dtype='f',
-            delimiter='\t',
-            skip_header=1,
-            usecols=[ch_col],
-        )
-        return ch_data
-
-    @staticmethod
-    def _reverse_find_in_buffer(f, s, buffer_size=8192):
+    def _add_nullbytes(buffer_str):
         """
-        Find 's' in buffer of file-handle 'f'
+        Encodes a string as UTF-16-LE, i.e. a nullbyte after each ascii character
 
-        :return: string with nullbits
+        :param buffer_str:
+        :return: bytes with nullbytes
         """
-        # based on http://stackoverflow.com/questions/3893885/cheap-way-to-search-a-large-text-file-for-a-string
-        f.seek(0, 2)
-
-        buf = None
-        overlap = len(s) - 1
-        bsize = buffer_size + overlap + 1
-        cur_pos = f.tell() - bsize + 1
-        offset = -2 * bsize + overlap
-        first_start = True
-        while cur_pos >= 0:
-            # print('seeking..')
-            f.seek(cur_pos)
-            buf = f.read(bsize)
-            if buf:
-                pos = buf.find(s)
-                if pos >= 0:
-                    return f.tell() - (len(buf) - pos)
-
-            cur_pos = f.tell() + offset
-            if (cur_pos < 0) and first_start:
-                first_start = False
-                cur_pos = 0
-        return -1
+        return buffer_str.encode("utf-16-le")
 
     @staticmethod
-    def _add_nullbytes(buffer_str):
+    def _etree_to_dict(t):
         """
-        Adds nullbytes after each character in a string
-
-        :param buffer_str:
-        :return: string with nullbits
+        converts an etree xml to a dictionary,
+        walking the tree with an explicit stack instead of recursion
         """
-        pad_str = ""
-        for s in buffer_str:
-            pad_str += s + "\x00"
-        return pad_str
+        # frames hold an element, an iterator over its children
+        # and the (tag, value) pairs of the children converted so far
+        stack = [(t, iter(t), [])]
+        while True:
+            node, children, converted = stack[-1]
+            child = next(children, None)
+            if child is not None:
+                stack.append((child, iter(child), []))
+                continue
+            stack.pop()
+            item = McdUtils._element_to_item(node, converted)
+            if not stack:
+                return {item[0]: item[1]}
+            stack[-1][2].append(item)
 
     @staticmethod
-    def _etree_to_dict(t):
+    def _element_to_item(t, converted):
         """
-        converts an etree xml to a dictionary
+        converts a single element to a (tag, value) pair,
+        given the already converted pairs of its children
         """
-        d = {t.tag: {} if t.attrib else None}
-        children = list(t)
-        if children:
-            dd = defaultdict(list)
-            for dc in map(McdUtils._etree_to_dict, children):
-                for k, v in dc.items():
-                    dd[k].append(v)
-            d = {
-                t.tag: {
-                    k: v[0] if (len(v) == 1 and ~isinstance(v[0], type(dict()))) else v
-                    for k, v in dd.items()
-                }
-            }
+        if converted:
+            dd = {}
+            for k, v in converted:
+                dd.setdefault(k, []).append(v)
+            value = {k: v[0] if len(v) == 1 else v for k, v in dd.items()}
+        else:
+            value = {} if t.attrib else None
         if t.attrib:
-            d[t.tag].update(("@" + k, v) for k, v in t.attrib.items())
+            value.update(("@" + k, v) for k, v in t.attrib.items())
         if t.text:
             text = t.text.strip()
-            if children or t.attrib:
+            if converted or t.attrib:
                 if text:
-                    d[t.tag]["#text"] = text
+                    value["#text"] = text
             else:
-                if t.tag == defs.ID or t.tag == defs.ORDERNUMBER:
-                    d[t.tag] = int(text)
+                if t.tag in _INT_TAGS:
+                    value = int(text)
                 else:
-                    d[t.tag] = text
-        return d
+                    value = text
+        return t.tag, value
 
     @staticmethod
     def xml2dict(xml):
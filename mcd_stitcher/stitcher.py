@@ -1,30 +1,67 @@
+import os
+import logging
 import zarr
+import warnings
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 from datetime import datetime
 from pathlib import Path
 import argparse
-import xarray as xr
 import tifffile
-import xmltodict
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
 from typing import Union
 
 class ZarrStitcher:
-    def __init__(self, zarr_folder, use_lzw=False):
+    def __init__(self, zarr_folder, use_lzw=False, jobs=None, compression=None, tile_size=None):
         self.zarr_folder = Path(zarr_folder)
         self.use_lzw = use_lzw
+        # TIFF compression, 'lzw' or 'zlib', use_lzw is kept as a shortcut for 'lzw'
+        self.compression = compression or ('lzw' if use_lzw else None)
+        # None writes each channel as strips, otherwise as tile_size x tile_size tiles
+        self.tile_size = tile_size
+        # number of folders stitched in parallel processes, None uses all cores
+        self.jobs = jobs
+        # folders actually being stitched at the same time, set by process_all_folders
+        self.folder_workers = 1
         self.log_file = self.zarr_folder / "error_log.txt"
+        # parsed channel labels per mcd_schema.xml, shared by all ROIs of a folder
+        self._schema_channels = {}
 
     def log_error(self, message):
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with open(self.log_file, "a") as f:
-            f.write(f"{timestamp} - {message}\n")
+        self.logger.error(message)
 
-    def extract_metadata(self, zarr_path):
-        """Extract metadata from the Zarr file."""
+    @property
+    def logger(self):
+        """File logger for error_log.txt, the file is opened on the first error and kept open until close_log."""
+        # keyed by the log file, so stitchers and worker processes of one folder share a handler
+        logger = logging.getLogger(f"{__name__}.{self.log_file}")
+        if not logger.handlers:
+            handler = logging.FileHandler(self.log_file, delay=True)
+            handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S"))
+            logger.addHandler(handler)
+            logger.setLevel(logging.ERROR)
+            logger.propagate = False
+        return logger
+
+    def close_log(self):
+        """Remove and close the error_log.txt handler, the next error opens the file again."""
+        logger = logging.getLogger(f"{__name__}.{self.log_file}")
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+
+    def extract_metadata(self, zarr_file, zarr_path):
+        """Extract metadata from the opened root group of the Zarr file at zarr_path."""
         metadata = []
         try:
-            zarr_file = zarr.open(str(zarr_path), mode='r')
-            for group_key in zarr_file.keys():
+            with warnings.catch_warnings():
+                # mcd_schema.xml and snapshots live next to the ROI groups
+                warnings.filterwarnings("ignore", message="Object at .* is not recognized")
+                group_keys = list(zarr_file.group_keys())
+            for group_key in group_keys:
                 group = zarr_file[group_key]
                 if 'meta' in group.attrs:
                     metas = group.attrs['meta']
@@ -38,6 +75,8 @@ class ZarrStitcher:
                                 'height': meta['q_maxy'],
                                 'roi_id': meta['q_id'],
                                 'file_path': zarr_path / group_key,
+                                # keep the opened array, stitching reads it once per channel
+                                'zarr_array': group[list(group.keys())[0]],
                                 'channels': meta.get('channels', [])  # Assuming 'channels' is in the metadata
                             }
                             metadata.append(roi_meta)
@@ -45,29 +84,88 @@ class ZarrStitcher:
             self.log_error(f"Error extracting metadata from {zarr_path}: {e}")
         return metadata
     
+    def zarr_store_path(self, zarr_folder):
+        """Return the Zarr store of a converted folder, a sibling <name>.zip takes precedence."""
+        zip_path = zarr_folder.parent / (zarr_folder.name + ".zip")
+        return zip_path if zip_path.is_file() else zarr_folder
+
+    @contextmanager
+    def open_store(self, store_path):
+        """Open the root group of a Zarr directory or zip store for reading, the store is closed on exit."""
+        if store_path.suffix == ".zip":
+            store = zarr.storage.ZipStore(store_path, mode='r')
+        else:
+            store = zarr.storage.LocalStore(str(store_path), read_only=True)
+        try:
+            yield zarr.open_group(store, mode='r')
+        finally:
+            store.close()
+
+    def read_roi(self, roi, channel, num_channels):
+        """Read a single channel of a ROI into memory, None for empty ROIs."""
+        image = roi['zarr_array']
+        if image.shape == (1, 1, 1):
+            return None
+        if image.shape[0] != num_channels:
+            raise ValueError(f"ROI has {image.shape[0]} channels, expected {num_channels}")
+        return image[channel]
+
+    def prefetch_rois(self, rois, channel, num_channels):
+        """Yield (roi, future) pairs in order, decompressing the next ROIs in background threads."""
+        workers = self.prefetch_workers()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for roi in rois:
+                pending.append((roi, executor.submit(self.read_roi, roi, channel, num_channels)))
+                # bound the number of decoded ROIs held in memory
+                if len(pending) > workers:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+
+    def prefetch_workers(self):
+        """ROI reader threads per folder, the cores are shared out between folders stitched in parallel."""
+        return max(1, (os.cpu_count() or 1) // self.folder_workers)
+
+    def parse_timestamp(self, timestamp):
+        """Parse a complex timestamp to a datetime, dropping the timezone and fractional seconds."""
+        return datetime.fromisoformat(timestamp.split("+")[0].split(".")[0])
+
     def convert_timestamp_to_simple_format(self, timestamp):
         """Convert complex timestamp to a simple format."""
-        dt = datetime.fromisoformat(timestamp.split("+")[0].split(".")[0])
+        dt = self.parse_timestamp(timestamp)
         return dt.strftime('%Y-%m-%dT%H:%M:%S')
     
     def extract_channel_names(self, zarr_folder, acquisition_id):
         """Extract channel names for a specific acquisition ID from the mcd_schema.xml file in the Zarr folder."""
+        return list(self.schema_channel_names(zarr_folder).get(str(acquisition_id), []))
+
+    def schema_channel_names(self, zarr_folder):
+        """Parse mcd_schema.xml once per folder and map each acquisition ID to its channel labels."""
         schema_file = zarr_folder / "mcd_schema.xml"
-        
+        if schema_file in self._schema_channels:
+            return self._schema_channels[schema_file]
+
         if not schema_file.exists():
             raise FileNotFoundError(f"Schema file not found: {schema_file}")
-        
-        with open(schema_file, 'r', encoding='utf-8') as file:
-            xml_content = file.read()
-            schema = xmltodict.parse(xml_content)
-            
-            channel_names = []
-            for channel in schema['MCDSchema']['AcquisitionChannel']:
-                if channel['AcquisitionID'] == str(acquisition_id):
-                    channel_names.append(channel['ChannelLabel'])
-
-            return channel_names
+
+        # stream the schema and keep only the AcquisitionChannel entries, the tree is never built in full
+        channel_names = {}
+        for _, element in ET.iterparse(schema_file, events=("end",)):
+            if self.local_name(element.tag) != "AcquisitionChannel":
+                continue
+            fields = {self.local_name(child.tag): (child.text or "").strip() or None for child in element}
+            channel_names.setdefault(fields.get("AcquisitionID"), []).append(fields.get("ChannelLabel"))
+            element.clear()
+
+        self._schema_channels[schema_file] = channel_names
+        return channel_names
     
+    @staticmethod
+    def local_name(tag):
+        """Strip the namespace from an element tag."""
+        return tag.rpartition("}")[2]
+
     def channels_by_roi(self, zarr_folder, rois):
         """Extract channel names for each ROI and return as a dictionary."""
         channels_by_roi = {}
@@ -95,72 +193,110 @@ class ZarrStitcher:
 
     def stitch_rois(self, rois, output_path, main_channel_labels):
         """Stitch ROIs into a single image and save as OME-TIFF."""
-        min_x = min(roi['stage_x'] for roi in rois)
-        min_y = min(roi['stage_y'] - roi['height'] for roi in rois)
-        max_x = max(roi['stage_x'] + roi['width'] for roi in rois)
-        max_y = max(roi['stage_y'] for roi in rois)
+        # Sort ROIs by timestamp in descending order, sorted() evaluates the key once per ROI
+        # and datetimes compare directly, without formatting them back to strings
+        # ROIs are pasted in this order, newest first, so where they overlap the oldest ROI is
+        # pasted last and its pixels are kept
+        rois = sorted(rois, key=lambda r: self.parse_timestamp(r['timestamp']), reverse=True)
+
+        stage_x, stage_y, min_x, max_y, stitched_width, stitched_height = self.canvas_bounds(rois)
 
-        stitched_width  = int(max_x - min_x)
-        stitched_height = int(max_y - min_y)
+        # destination slices of all ROIs in one pass, instead of once per ROI and channel
+        x_offsets = (stage_x - min_x).astype(int)
+        y_offsets = np.abs((stage_y - max_y).astype(int))
+        for roi, x_offset, y_offset in zip(rois, x_offsets.tolist(), y_offsets.tolist()):
+            _, roi_height, roi_width = roi['zarr_array'].shape
+            roi['target'] = (slice(y_offset, y_offset + roi_height), slice(x_offset, x_offset + roi_width))
         
         # Determine the maximum number of channels
         max_channels = 0
         for roi in rois:
             try:
-                sample_zarr = zarr.open(roi['file_path'], mode='r')
-                num_channels = sample_zarr[roi['file_path'].name][:].shape[0]
+                # the array shape is in its metadata, no chunk needs to be decompressed
+                num_channels = roi['zarr_array'].shape[0]
                 max_channels = max(max_channels, num_channels)
             except Exception as e:
                 self.log_error(f"Error determining channels for ROI ID: {roi['roi_id']} in {roi['file_path']}, Error: {e}")
 
-        stitched_image = np.zeros((max_channels, stitched_height, stitched_width), dtype=np.uint16)
+        # Stream the stitched image one channel at a time, only a single plane is held in memory
+        planes = self.stitch_planes(rois, max_channels, stitched_height, stitched_width)
+        # build the next plane while the current one is compressed and written
+        planes = self.read_ahead(planes)
 
-        # Sort ROIs by timestamp in descending order
-        rois = sorted(rois, key=lambda r: self.convert_timestamp_to_simple_format(r['timestamp']), reverse=True)
+        # Save the stitched image as an OME-TIFF file
+        self.write_ometiff_planes(
+            planes, (max_channels, stitched_height, stitched_width), main_channel_labels[:max_channels], output_path
+        )
 
-        for roi in rois:
-            try:
-                zarr_group = zarr.open(roi['file_path'], mode='r')
-                image_key = list(zarr_group.keys())[0]
-                image = zarr_group[image_key][:]  # Load all channels
-
-                # Check if the image is empty (shape is (1, 1, 1))
-                if image.shape == (1, 1, 1):
-                    # print(f"Skipping empty ROI ID: {roi['roi_id']}")
-                    continue
-
-                x_offset = int(roi['stage_x'] - min_x)
-                y_offset = abs(int(roi['stage_y'] - max_y))
-                
-                stitched_image[:, y_offset:y_offset + image.shape[1], x_offset:x_offset + image.shape[2]] = image
-            except Exception as e:
-                self.log_error(f"Error processing ROI ID: {roi['roi_id']} in {roi['file_path']}, Error: {e}")
+    @staticmethod
+    def canvas_bounds(rois):
+        """Return the ROI stage positions, min x, max y and the width and height of the stitched canvas."""
+        # one (stage_x, stage_y, width, height) row per ROI, reduced column-wise
+        bounds = np.array([(roi['stage_x'], roi['stage_y'], roi['width'], roi['height']) for roi in rois], dtype=np.float64)
+        stage_x, stage_y, width, height = bounds.T
+        min_x = float(stage_x.min())
+        min_y = float((stage_y - height).min())
+        max_x = float((stage_x + width).max())
+        max_y = float(stage_y.max())
+        return stage_x, stage_y, min_x, max_y, int(max_x - min_x), int(max_y - min_y)
 
-        # Convert to xarray DataArray to use the write_ometiff function
-        stitched_da = xr.DataArray(
-            stitched_image,
-            dims=("c", "y", "x"),
-            coords={"c": main_channel_labels[:max_channels], "y": range(stitched_height), "x": range(stitched_width)}
-        )
+    def stitch_planes(self, rois, num_channels, height, width):
+        """Yield the stitched image channel by channel, pasting the matching channel of every ROI."""
+        failed = set()
+        for channel in range(num_channels):
+            stitched_plane = np.zeros((height, width), dtype=np.uint16)
+            for roi, future in self.prefetch_rois([r for r in rois if id(r) not in failed], channel, num_channels):
+                try:
+                    image = future.result()
 
-        # Save the stitched image as an OME-TIFF file
-        self.write_ometiff(stitched_da, output_path)
+                    # Skip empty ROIs (shape is (1, 1, 1))
+                    if image is None:
+                        continue
+
+                    target = stitched_plane[roi['target']]
+                    if image.min() >= 0 and image.max() <= 65535:
+                        # IMC counts are usually within uint16 range, a plain cast is enough
+                        target[...] = image
+                    else:
+                        # clip and cast straight into the canvas, without float or uint16 temporaries
+                        np.clip(image, 0, 65535, out=target, casting='unsafe')
+                except Exception as e:
+                    # log once and leave the ROI out of the remaining channels
+                    failed.add(id(roi))
+                    self.log_error(f"Error processing ROI ID: {roi['roi_id']} in {roi['file_path']}, Error: {e}")
+            yield stitched_plane
+
+    def read_ahead(self, iterator):
+        """Yield the items of an iterator while the next one is produced in a background thread."""
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(next, iterator, None)
+            while True:
+                item = future.result()
+                if item is None:
+                    return
+                future = executor.submit(next, iterator, None)
+                yield item
 
-    def write_ometiff(self, imarr: xr.DataArray, outpath: Union[Path, str], **kwargs) -> None:
-        """Write DataArray to a multi-page OME-TIFF file with proper metadata."""
+    def write_ometiff(self, image: np.ndarray, channel_labels, outpath: Union[Path, str], **kwargs) -> None:
+        """Write a (c, y, x) array to a multi-page OME-TIFF file with proper metadata."""
+        self.write_ometiff_planes(
+            iter(image.astype(np.uint16, copy=False)), image.shape, channel_labels, outpath, **kwargs
+        )
+
+    def write_ometiff_planes(self, planes, shape, channel_labels, outpath: Union[Path, str], **kwargs) -> None:
+        """Write uint16 channel planes from an iterator to a multi-page OME-TIFF file with proper metadata."""
         outpath = Path(outpath)
-        imarr = imarr.transpose("c", "y", "x")
-        Nc, Ny, Nx = imarr.shape    
+        Nc, Ny, Nx = shape
         # Generate standard OME-XML
         channels_xml = '\n'.join(
-            [f"""<Channel ID="Channel:0:{i}" Name="{channel}" SamplesPerPixel="1" />"""
-                for i, channel in enumerate(imarr.c.values)]
+            [f"""<Channel ID="Channel:0:{i}" Name={quoteattr(str(channel))} SamplesPerPixel="1" />"""
+                for i, channel in enumerate(channel_labels)]
         )
         xml = f"""<?xml version="1.0" encoding="UTF-8"?>
         <OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06"
                 xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
                 xsi:schemaLocation="http://www.openmicroscopy.org/Schemas/OME/2016-06 http://www.openmicroscopy.org/Schemas/OME/2016-06/ome.xsd">
-            <Image ID="Image:0" Name="{outpath.stem}">
+            <Image ID="Image:0" Name={quoteattr(outpath.stem)}>
                 <Pixels BigEndian="false"
                         DimensionOrder="XYZCT"
                         ID="Pixels:0"
@@ -181,54 +317,170 @@ class ZarrStitcher:
         """
         outpath.parent.mkdir(parents=True, exist_ok=True)
         # Note resolution: 1 um/px = 25400 px/inch
-        if self.use_lzw:
-            tifffile.imwrite(outpath, data=imarr.values, description=xml, contiguous=True,
-                            compression='lzw', resolution=(25400, 25400, "inch"), **kwargs)
+        options = dict(shape=shape, dtype=np.uint16, description=xml, resolution=(25400, 25400, "inch"))
+        # tifffile cannot size an iterator, so BigTIFF is decided from the declared shape on every path
+        options['bigtiff'] = kwargs.pop('bigtiff', self.needs_bigtiff(shape, np.uint16))
+        if self.compression:
+            # strips and tiles are compressed independently, spread them over all cores
+            # unless other folders are being stitched in parallel processes
+            maxworkers = os.cpu_count() if self.folder_workers <= 1 else 1
+            options.update(compression=self.compression, maxworkers=maxworkers)
+            if self.compression == 'zlib':
+                # horizontal differencing makes the smooth IMC channels compress much better
+                options['predictor'] = True
+        # planes are consumed one at a time, so the full image is never held in memory
+        if self.tile_size:
+            options['tile'] = (self.tile_size, self.tile_size)
+            planes = self.iter_tiles(planes, self.tile_size)
+        elif self.compression:
+            # tifffile compresses iterators only tile by tile, compressed strips are written page by page
+            self.write_pages(outpath, planes, options, **kwargs)
+            return
         else:
-            tifffile.imwrite(outpath, data=imarr.values, description=xml, contiguous=True,
-                            resolution=(25400, 25400, "inch"), **kwargs)
+            options['contiguous'] = True
+        tifffile.imwrite(outpath, data=planes, **options, **kwargs)
+
+    @staticmethod
+    def write_pages(outpath: Path, planes, options, **kwargs) -> None:
+        """Write channel planes as one page each, the OME-XML goes into the first page."""
+        options = dict(options)
+        for key in ('shape', 'dtype'):
+            del options[key]
+        description, bigtiff = options.pop('description'), options.pop('bigtiff')
+        with tifffile.TiffWriter(outpath, bigtiff=bigtiff) as tif:
+            for plane in planes:
+                tif.write(plane, description=description, metadata=None, contiguous=False, **options, **kwargs)
+                description = None
+
+    @staticmethod
+    def needs_bigtiff(shape, dtype):
+        """Whether an image needs BigTIFF, switching before the 4 GB offset limit as tifffile.imwrite does."""
+        return int(np.prod(shape)) * np.dtype(dtype).itemsize > 2**32 - 2**25
+
+    @staticmethod
+    def iter_tiles(planes, tile_size):
+        """Split planes into tiles in the row-major order tifffile expects, edge tiles are padded by tifffile."""
+        for plane in planes:
+            for y in range(0, plane.shape[0], tile_size):
+                for x in range(0, plane.shape[1], tile_size):
+                    yield plane[y:y + tile_size, x:x + tile_size]
 
     def process_all_folders(self):
         """Process all Zarr folders."""
         zarr_folders = [d for d in self.zarr_folder.iterdir() if d.is_dir()]
-        for zarr_folder in zarr_folders:
-            try:
-                # Check for the presence of mcd_schema.xml
-                schema_file = zarr_folder / "mcd_schema.xml"
-                if not schema_file.exists():
-                    print(f"Skipping {zarr_folder.name}: No mcd_schema.xml found.")
-                    continue
-                
-                # Extract the folder name to use in output file name
-                folder_name = zarr_folder.name
-
-                output_filename = folder_name + "_stitched.ome.tiff"
-                output_path = self.zarr_folder / output_filename
+        jobs = min(self.jobs or os.cpu_count() or 1, len(zarr_folders))
+        try:
+            if self.jobs is None and jobs > 1:
+                jobs = self.memory_bound_jobs(zarr_folders, jobs)
+            self.folder_workers = max(1, jobs)
+            if jobs <= 1:
+                for zarr_folder in zarr_folders:
+                    self.process_folder(zarr_folder)
+            else:
+                # folders are stitched independently, run them in separate processes
+                with ProcessPoolExecutor(max_workers=jobs) as executor:
+                    for future in [executor.submit(self.process_folder, d) for d in zarr_folders]:
+                        future.result()
+        finally:
+            # errors logged by this process while scanning the folders
+            self.close_log()
+
+    def memory_bound_jobs(self, zarr_folders, jobs):
+        """Lower the number of parallel folders so their estimated peak memory fits in the available RAM."""
+        memory = available_memory()
+        if not memory:
+            return jobs
+        # reader threads each folder would get with the unbounded number of jobs
+        threads = max(1, (os.cpu_count() or 1) // jobs)
+        need = max(self.folder_memory(zarr_folder, threads) for zarr_folder in zarr_folders)
+        return max(1, min(jobs, memory // need)) if need else jobs
+
+    def folder_memory(self, zarr_folder, threads):
+        """Estimate the peak memory of stitching a folder from its metadata, no pixels are read."""
+        if not (zarr_folder / "mcd_schema.xml").exists():
+            return 0
+        store_path = self.zarr_store_path(zarr_folder)
+        try:
+            with self.open_store(store_path) as zarr_file:
+                rois = self.extract_metadata(zarr_file, store_path)
+        except Exception:
+            # unreadable folders fail and are logged when they are stitched
+            return 0
+        if not rois:
+            return 0
+        *_, width, height = self.canvas_bounds(rois)
+        # the canvas plane and the read-ahead plane, both uint16
+        canvas = 2 * width * height * np.dtype(np.uint16).itemsize
+        # one decoded channel per prefetched ROI, the window holds one more than the reader threads
+        roi_plane = max(roi['zarr_array'].nbytes // max(1, roi['zarr_array'].shape[0]) for roi in rois)
+        return canvas + (threads + 1) * roi_plane
+
+    def process_folder(self, zarr_folder):
+        """Stitch a single Zarr folder into an OME-TIFF, errors are logged."""
+        try:
+            # Check for the presence of mcd_schema.xml
+            schema_file = zarr_folder / "mcd_schema.xml"
+            if not schema_file.exists():
+                print(f"Skipping {zarr_folder.name}: No mcd_schema.xml found.")
+                return
 
+            # Extract the folder name to use in output file name
+            folder_name = zarr_folder.name
+
+            output_filename = folder_name + "_stitched.ome.tiff"
+            output_path = self.zarr_folder / output_filename
+
+            # the store stays open while the ROI arrays are read and is closed once the folder is stitched
+            store_path = self.zarr_store_path(zarr_folder)
+            with self.open_store(store_path) as zarr_file:
                 # Extract metadata from the current Zarr file
-                rois = self.extract_metadata(zarr_folder)
+                rois = self.extract_metadata(zarr_file, store_path)
 
                 if not rois:
                     self.log_error(f"No ROIs found in folder: {zarr_folder}")
-                    continue
+                    return
 
                 # Extract channel names from the mcd_schema.xml file for each ROI
                 channels_by_roi = self.channels_by_roi(zarr_folder, rois)
-                
+
                 # Compare channels and get main channel labels
                 main_channel_labels = self.compare_channels(channels_by_roi)
 
                 if not main_channel_labels:
                     self.log_error(f"No valid channel labels found in folder: {zarr_folder}")
-                    continue
+                    return
 
                 # Stitch the ROIs and save the result
                 self.stitch_rois(rois, output_path, main_channel_labels)
-                
-                print(f"Successfully stitched: {zarr_folder.name}")
-            except Exception as e:
-                self.log_error(f"Error processing folder {zarr_folder.name}: {e}")
-                print(f"Error processing folder {zarr_folder.name}, check the log for details.")
+
+            print(f"Successfully stitched: {zarr_folder.name}")
+        except Exception as e:
+            self.log_error(f"Error processing folder {zarr_folder.name}: {e}")
+            print(f"Error processing folder {zarr_folder.name}, check the log for details.")
+        finally:
+            # release error_log.txt between folders, an open handle keeps it locked on Windows
+            self.close_log()
+
+def available_memory():
+    """Available physical memory in bytes, None where the platform does not report it."""
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def positive_int(value):
+    """argparse type for counts such as --jobs, which must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+def tile_size(value):
+    """argparse type for --tile-size, TIFF tiles must be a positive multiple of 16."""
+    number = int(value)
+    if number < 16 or number % 16:
+        raise argparse.ArgumentTypeError(f"must be a positive multiple of 16, got {value}")
+    return number
 
 def main():
     parser = argparse.ArgumentParser(description="""
@@ -239,10 +491,16 @@ def main():
     """)
     parser.add_argument("zarr_folder", type=str, help="Path to the Zarr folder")
     parser.add_argument("--lzw", action="store_true", help="Enable LZW compression")
+    parser.add_argument("--zlib", action="store_true", help="Enable zlib compression with horizontal predictor")
+    parser.add_argument("--tile-size", type=tile_size, default=None, help="Write tiles of this size instead of strips, a positive multiple of 16")
+    parser.add_argument("-j", "--jobs", type=positive_int, default=None, help="Number of folders stitched in parallel, defaults to all cores")
     
     args = parser.parse_args()
     
-    stitcher = ZarrStitcher(args.zarr_folder, use_lzw=args.lzw)
+    stitcher = ZarrStitcher(
+        args.zarr_folder, use_lzw=args.lzw, jobs=args.jobs,
+        compression='zlib' if args.zlib else None, tile_size=args.tile_size
+    )
     stitcher.process_all_folders()
 
 if __name__ == "__main__":
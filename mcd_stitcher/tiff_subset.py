@@ -1,35 +1,75 @@
 import argparse
 import os
+import re
+import itertools
 import tifffile
 import numpy as np
+import zarr
 import xml.etree.ElementTree as ET
-from typing import List, Union
+from xml.sax.saxutils import quoteattr
+from typing import Iterator, List, Tuple, Union
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import traceback
 from datetime import datetime
+from .stitcher import available_memory, positive_int
 
+# output buffer of the pyramid writer, sized to hold many compressed tiles
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
 
-def read_ome_tiff(tiff_path: str) -> (np.ndarray, List[str]):
+# default filtering keeps channels whose name contains a metal mass between 141 and 193
+METAL_PATTERN = re.compile(r'14[1-9]|1[5-8]\d|19[0-3]')
+
+
+@contextmanager
+def read_ome_tiff(tiff_path: str) -> Iterator[Tuple[Union[np.ndarray, zarr.Array], List[str]]]:
+    # the image is opened lazily, only the channels indexed by the caller are read from disk
+    channel_names = _get_channel_names(tiff_path)
+    try:
+        # uncompressed contiguous files are memory-mapped
+        image_data = tifffile.memmap(tiff_path, mode='r')
+    except ValueError:
+        image_data = None
+    if image_data is not None:
+        yield image_data, channel_names
+        return
+    # compressed, tiled or pyramidal files open their full resolution level as a zarr array,
+    # the store and the file are closed when the caller's block exits
+    with tifffile.TiffFile(tiff_path) as tif, tif.series[0].aszarr(level=0) as store:
+        yield zarr.open(store, mode='r'), channel_names
+
+def _get_channel_names(tiff_path: str) -> List[str]:
+    # only the OME-XML in the first page is read, no pixel data is decoded
     with tifffile.TiffFile(tiff_path) as tif:
-        image_data = tif.asarray()
         ome_metadata = tif.ome_metadata
 
     # Parse OME-XML metadata to extract channel names
     root = ET.fromstring(ome_metadata)
     namespace = {'ome': 'http://www.openmicroscopy.org/Schemas/OME/2016-06'}
     channel_elements = root.findall('.//ome:Channel', namespace)
-    channel_names = [channel.get('Name') for channel in channel_elements]
+    return [channel.get('Name') for channel in channel_elements]
 
-    return image_data, channel_names
+def compression_options(compression: Union[str, None], maxworkers: Union[int, None] = None) -> dict:
+    """Return the tifffile write options for the given compression, None writes uncompressed."""
+    if not compression:
+        return {}
+    # strips and tiles are compressed independently, spread them over all cores by default
+    options = dict(compression=compression, maxworkers=maxworkers or os.cpu_count())
+    if compression == 'zlib':
+        # horizontal differencing makes the smooth IMC channels compress much better
+        options['predictor'] = True
+    return options
 
-def write_ome_tiff(image_data: np.ndarray, channel_names: List[str], output_path: str):
-    # Generate OME-XML metadata
-    channels_xml = ''.join([f'<Channel ID="Channel:0:{i}" Name="{name}" SamplesPerPixel="1"/>' for i, name in enumerate(channel_names)])
+def write_ome_tiff(image_data: np.ndarray, channel_names: List[str], output_path: str,
+                   compression: Union[str, None] = None, maxworkers: Union[int, None] = None):
+    # Generate OME-XML metadata, quoteattr escapes channel names such as 'CD4 <Nd145>'
+    channels_xml = ''.join([f'<Channel ID="Channel:0:{i}" Name={quoteattr(name or "")} SamplesPerPixel="1"/>' for i, name in enumerate(channel_names)])
     xml_metadata = f"""<?xml version="1.0" encoding="UTF-8"?>
     <OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06"
         xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
         xsi:schemaLocation="http://www.openmicroscopy.org/Schemas/OME/2016-06 http://www.openmicroscopy.org/Schemas/OME/2016-06/ome.xsd">
-        <Image ID="Image:0" Name="{os.path.basename(output_path)}">
+        <Image ID="Image:0" Name={quoteattr(os.path.basename(output_path))}>
             <Pixels BigEndian="false"
                     DimensionOrder="XYZCT"
                     ID="Pixels:0"
@@ -49,27 +89,66 @@ def write_ome_tiff(image_data: np.ndarray, channel_names: List[str], output_path
     </OME>"""
     
     # Write OME-TIFF file
-    tifffile.imwrite(output_path, image_data, description=xml_metadata, metadata={'axes': 'CYX'})
+    tifffile.imwrite(output_path, image_data, description=xml_metadata, metadata={'axes': 'CYX'},
+                     **compression_options(compression, maxworkers))
+
+def downsample(image: np.ndarray) -> np.ndarray:
+    """Halve the height and width of a (C, H, W) image with a 2x2 block mean."""
+    channels, height, width = image.shape
+    out = np.empty((channels, -(-height // 2), -(-width // 2)), dtype=image.dtype)
+    for idx, plane in enumerate(image):
+        # odd edges are averaged with themselves, so the level keeps the ceil(H/2) x ceil(W/2) shape
+        if height % 2 or width % 2:
+            plane = np.pad(plane, ((0, height % 2), (0, width % 2)), mode='edge')
+        if image.dtype.kind == 'u':
+            # sums of four uint16 pixels fit in uint32, +2 rounds to the nearest integer
+            acc = plane[0::2, 0::2].astype(np.uint32)
+            acc += plane[1::2, 0::2]
+            acc += plane[0::2, 1::2]
+            acc += plane[1::2, 1::2]
+            acc += 2
+            acc >>= 2
+        else:
+            acc = plane[0::2, 0::2].astype(np.float64)
+            acc += plane[1::2, 0::2]
+            acc += plane[0::2, 1::2]
+            acc += plane[1::2, 1::2]
+            acc /= 4
+        out[idx] = acc
+    return out
 
 def create_pyramid(image, levels=4):
-    """Create a list of downsampled images to form pyramid levels."""
-    pyramid = [image]
+    """Yield the pyramid levels one at a time, only the previous level is kept alive."""
+    yield image
     for level in range(1, levels):
-        scale = 2 ** level
-        downsampled = image[:, ::scale, ::scale]
-        pyramid.append(downsampled)
-    return pyramid
+        # each level is averaged from the previous one instead of subsampling the base
+        image = downsample(image)
+        yield image
 
-def write_pyramidal_tiff(image_data: np.ndarray, channel_names: List[str], output_path: str):
-    tile_size = (256, 256)
-    levels = 4
+def level_tile(shape, tile_size=256):
+    """Return the tile shape for a pyramid level, None if the level fits in a single tile."""
+    height, width = shape[-2:]
+    if height <= tile_size and width <= tile_size:
+        # a lone tile would only be zero padding around a small level, write strips instead
+        return None
+    # tiles shrink to the level (in multiples of 16 as TIFF requires) instead of padding it
+    return (min(tile_size, -(-height // 16) * 16), min(tile_size, -(-width // 16) * 16))
 
-    pyramid_levels = create_pyramid(image_data, levels=levels)
-    
-    with tifffile.TiffWriter(output_path, bigtiff=True) as tif:
-        options = dict(tile=tile_size, metadata={'axes': 'CYX', 'Channel': {'Name': channel_names}})
+def write_pyramidal_tiff(image_data: np.ndarray, channel_names: List[str], output_path: str,
+                         compression: Union[str, None] = None, tile_size: int = 256,
+                         pyramid_levels=None, levels: int = 4, maxworkers: Union[int, None] = None):
+    # pyramid_levels iterates over all levels starting with image_data, None downsamples image_data
+    if pyramid_levels is None:
+        pyramid_levels = create_pyramid(image_data, levels=levels)
 
+    # a large buffer coalesces the many small tile writes into few syscalls
+    with open(output_path, 'wb', buffering=WRITE_BUFFER_SIZE) as fh, tifffile.TiffWriter(fh, bigtiff=True) as tif:
+        options = dict(metadata={'axes': 'CYX', 'Channel': {'Name': channel_names}},
+                       **compression_options(compression, maxworkers))
+
+        # levels are computed just before they are written, so the pyramid is never held in memory
         for level, img in enumerate(pyramid_levels):
+            options['tile'] = level_tile(img.shape, tile_size)
             if level == 0:
                 # Write base level
                 tif.write(img, subifds=levels-1, **options)
@@ -77,8 +156,16 @@ def write_pyramidal_tiff(image_data: np.ndarray, channel_names: List[str], outpu
                 # Write pyramid levels
                 tif.write(img, subfiletype=1, **options)
 
+@contextmanager
+def read_pyramid_levels(tiff_path: str) -> Iterator[List[zarr.Array]]:
+    """Open the reduced resolution levels of a pyramidal OME-TIFF lazily, empty if it has none."""
+    with tifffile.TiffFile(tiff_path) as tif, ExitStack() as stack:
+        series = tif.series[0]
+        stores = [stack.enter_context(series.aszarr(level=level)) for level in range(1, len(series.levels))]
+        yield [zarr.open(store, mode='r') for store in stores]
+
 def list_channels(tiff_path: str):
-    image_data, channel_names = read_ome_tiff(tiff_path)
+    channel_names = _get_channel_names(tiff_path)
     print(f"Channels in {tiff_path}:")
     for idx, name in enumerate(channel_names):
         print(f"Channel {idx}: {name}")
@@ -93,16 +180,22 @@ def parse_channels(channel_str: str) -> List[int]:
             channels.append(int(part))
     return channels
 
-def subset_tiff(tiff_path: str, channels: Union[List[int], None], pyramid: bool, log_file: str):
+def select_channels(image_data, channels: List[int]):
+    """Index the channels of a (C, H, W) image, consecutive channels are sliced without a copy."""
+    if len(channels) and all(b - a == 1 for a, b in zip(channels, channels[1:])):
+        # a basic slice keeps a memory-mapped image a view
+        return image_data[channels[0]:channels[-1] + 1]
+    return image_data[channels, :, :]
+
+def subset_tiff(tiff_path: str, channels: Union[List[int], None], pyramid: bool, log_file: str,
+                compression: Union[str, None] = None, maxworkers: Union[int, None] = None):
     try:
-        image_data, channel_names = read_ome_tiff(tiff_path)
-        
-        if channels is None:
-            channels = [i for i, name in enumerate(channel_names) if
-                        any(metal in name for metal in [f"{i}" for i in range(141, 194)])]
-        
-        # Subset the image data and channel names
-        subset_image_data = image_data[channels, :, :]
+        with read_ome_tiff(tiff_path) as (image_data, channel_names):
+            if channels is None:
+                channels = [i for i, name in enumerate(channel_names) if name and METAL_PATTERN.search(name)]
+
+            # Subset the image data and channel names, this reads only the selected channels
+            subset_image_data = np.asarray(select_channels(image_data, channels))
         subset_channel_names = [channel_names[i] for i in channels]
 
         # Generate output path
@@ -112,24 +205,71 @@ def subset_tiff(tiff_path: str, channels: Union[List[int], None], pyramid: bool,
         if pyramid:
             output_path = f"{base}_filtered_pyramid.ome.tiff"
             # Create and write pyramidal OME-TIFF
-            write_pyramidal_tiff(subset_image_data, subset_channel_names, output_path)
+            with read_pyramid_levels(tiff_path) as reduced_levels:
+                if reduced_levels:
+                    # the input is already pyramidal, subset its levels instead of downsampling again
+                    write_pyramidal_tiff(
+                        subset_image_data, subset_channel_names, output_path, compression=compression,
+                        maxworkers=maxworkers, pyramid_levels=itertools.chain(
+                            [subset_image_data],
+                            (np.asarray(select_channels(level, channels)) for level in reduced_levels)
+                        ),
+                        levels=len(reduced_levels) + 1
+                    )
+                else:
+                    write_pyramidal_tiff(subset_image_data, subset_channel_names, output_path, compression=compression,
+                                         maxworkers=maxworkers)
         else:
             # Write regular OME-TIFF
-            write_ome_tiff(subset_image_data, subset_channel_names, output_path)
+            write_ome_tiff(subset_image_data, subset_channel_names, output_path, compression=compression,
+                           maxworkers=maxworkers)
         
         print(f"OME-TIFF file written to {output_path}")
     except Exception as e:
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # a single append per error, so entries from parallel workers do not interleave
         with open(log_file, 'a') as log:
-            log.write(f"{timestamp} - Error processing {tiff_path}: {str(e)}\n")
-            log.write(traceback.format_exc() + '\n')
+            log.write(f"{timestamp} - Error processing {tiff_path}: {str(e)}\n{traceback.format_exc()}\n")
         print(f"{timestamp} - Error processing {tiff_path}. Logged the error and continuing...")
 
-def process_folder(folder_path: str, pyramid: bool, log_file: str):
+def process_folder(folder_path: str, pyramid: bool, log_file: str, jobs: Union[int, None] = None,
+                   compression: Union[str, None] = None):
+    tiff_files = []
+    # os.walk lists directories with scandir, files are filtered by name without a stat call
     for root, dirs, files in os.walk(folder_path):
-        for file in files:
-            if file.endswith('.tiff') or file.endswith('.ome.tiff'):
-                subset_tiff(os.path.join(root, file), None, pyramid, log_file)
+        # '.ome.tiff' files also end with '.tiff', a single suffix check covers both
+        tiff_files.extend(os.path.join(root, file) for file in files if file.endswith('.tiff'))
+
+    workers = min(jobs or os.cpu_count() or 1, len(tiff_files))
+    if jobs is None and workers > 1:
+        workers = memory_bound_jobs(tiff_files, workers)
+    if workers <= 1:
+        for tiff_file in tiff_files:
+            subset_tiff(tiff_file, None, pyramid, log_file, compression=compression)
+    else:
+        # files are subset independently, run them in separate processes that compress single-threaded
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(subset_tiff, f, None, pyramid, log_file, compression, 1) for f in tiff_files]
+            for future in futures:
+                future.result()
+
+def memory_bound_jobs(tiff_files: List[str], jobs: int) -> int:
+    """Lower the number of parallel files to the available RAM divided by the average image size."""
+    memory = available_memory()
+    if not memory:
+        return jobs
+    # a worker holds at most the full uncompressed image of its file
+    average = sum(image_memory(tiff_file) for tiff_file in tiff_files) / len(tiff_files)
+    return max(1, min(jobs, int(memory // average))) if average else jobs
+
+def image_memory(tiff_path: str) -> int:
+    """Uncompressed size of the full resolution image, read from the TIFF metadata only."""
+    try:
+        with tifffile.TiffFile(tiff_path) as tif:
+            return tif.series[0].nbytes
+    except Exception:
+        # unreadable files fail and are logged when they are subset
+        return 0
 
 def main():
     parser = argparse.ArgumentParser(description="""
@@ -142,19 +282,22 @@ def main():
     parser.add_argument("-c", action="store_true", help="Lists all channels in the OME-TIFF file.")
     parser.add_argument("-f", type=str, nargs='?', const='', help="Filter and subset channels. Provide channels to subset, e.g., '0-5,7,10'. If no channels are provided, default filtering is applied.")
     parser.add_argument("-p", action="store_true", help="Create pyramidal-tiled OME-TIFF")
+    parser.add_argument("--zlib", action="store_true", help="Enable zlib compression with horizontal predictor")
+    parser.add_argument("-j", "--jobs", type=positive_int, default=None, help="Number of files processed in parallel when a directory is given, defaults to all cores")
 
     args = parser.parse_args()
 
     log_file = os.path.join(args.tiff_path, "error_log.txt")
+    compression = 'zlib' if args.zlib else None
 
     if os.path.isdir(args.tiff_path):
-        process_folder(args.tiff_path, args.p, log_file)
+        process_folder(args.tiff_path, args.p, log_file, jobs=args.jobs, compression=compression)
     else:
         if args.c:
             list_channels(args.tiff_path)
         elif args.f is not None:
             channels = parse_channels(args.f) if args.f else None
-            subset_tiff(args.tiff_path, channels, args.p, log_file)
+            subset_tiff(args.tiff_path, channels, args.p, log_file, compression=compression)
         else:
             print("No action specified. Use -c to list channels, -f to filter and subset channels, or -p to create a pyramidal OME-TIFF.")
 
@@ -18,16 +18,15 @@ setup(
         'Operating System :: OS Independent',
     ],
     packages=find_packages(),
-    python_requires='>=3.10',
+    python_requires='>=3.11',
     install_requires=[
         'click',
         'numpy',
         'pandas',
         'python_dateutil',
-        'xarray',
-        'zarr',
+        'zarr>=3',
+        'numcodecs',
         'scikit-image',
-        'xmltodict',
         'tifffile'
     ],
     entry_points={
@@ -0,0 +1,65 @@
+import argparse
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pytest
+import tifffile
+
+from mcd_stitcher import stitcher
+from mcd_stitcher.stitcher import ZarrStitcher
+
+OME_NS = '{http://www.openmicroscopy.org/Schemas/OME/2016-06}'
+
+
+@pytest.mark.parametrize('options, compression', [
+    # zarr_stitch/mcd_stitch --lzw
+    ({'use_lzw': True}, 'LZW'),
+    # zarr_stitch/mcd_stitch --zlib
+    ({'compression': 'zlib'}, 'ADOBE_DEFLATE'),
+])
+def test_write_ometiff_compressed_strips_round_trip(tmp_path, options, compression):
+    image = np.random.default_rng(0).integers(0, 65535, size=(3, 60, 90), dtype=np.uint16)
+    labels = ['Ir191', 'Nd142', 'Sm149']
+    outpath = tmp_path / 'stitched.ome.tiff'
+
+    ZarrStitcher(tmp_path, **options).write_ometiff(image, labels, outpath)
+
+    with tifffile.TiffFile(outpath) as tif:
+        assert tif.series[0].axes == 'CYX'
+        assert tif.pages[0].compression.name == compression and not tif.pages[0].is_tiled
+        np.testing.assert_array_equal(tif.asarray(), image)
+        root = ET.fromstring(tif.ome_metadata)
+    assert [c.get('Name') for c in root.iter(f'{OME_NS}Channel')] == labels
+
+
+@pytest.mark.parametrize('tile_size', [None, 256])
+@pytest.mark.parametrize('shape, bigtiff', [
+    # a 40 channel 12000 x 12000 uint16 stitch is about 11.5 GB
+    ((40, 12000, 12000), True),
+    ((3, 60, 90), False),
+])
+def test_write_ometiff_planes_bigtiff_from_declared_shape(tmp_path, monkeypatch, shape, bigtiff, tile_size):
+    calls = []
+    monkeypatch.setattr(tifffile, 'imwrite', lambda *args, **kwargs: calls.append(kwargs))
+
+    # the planes are never consumed by the spy, only the declared shape matters
+    ZarrStitcher(tmp_path, tile_size=tile_size).write_ometiff_planes(iter([]), shape, ['Ir191'] * shape[0], tmp_path / 'big.ome.tiff')
+
+    assert calls[0]['bigtiff'] is bigtiff
+
+
+def test_memory_bound_jobs_fits_folders_in_available_memory(tmp_path, monkeypatch):
+    monkeypatch.setattr(stitcher, 'available_memory', lambda: 10 * 2**30)
+    monkeypatch.setattr(ZarrStitcher, 'folder_memory', lambda self, zarr_folder, threads: 4 * 2**30)
+
+    assert ZarrStitcher(tmp_path).memory_bound_jobs([tmp_path] * 8, 8) == 2
+
+
+@pytest.mark.parametrize('value', ['0', '-16', '100'])
+def test_tile_size_rejects_invalid_tiles(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        stitcher.tile_size(value)
+
+
+def test_tile_size_accepts_multiples_of_16():
+    assert stitcher.tile_size('256') == 256